@@ -1,11 +1,17 @@
-import json
+import os
+import orjson
+import socket
 import logging
 import asyncio
-from aiohttp import web, ClientSession
+from aiohttp import web
 from typing import Dict
+from collections import OrderedDict
+from pathlib import Path
+from time import monotonic
 
 import slack
 import settings
+from tracker import TrackerPool, owner_ttl
 
 if not settings.USE_MOCK:
     from tracker import Tracker
@@ -13,14 +19,111 @@ else:
     from tracker import MockingTracker
     class Tracker(MockingTracker):
         responses = [
-            json.load(open("examples/deliveroo-order-ongoing.json")),
-            json.load(open("examples/deliveroo-order-delivering.json")),
-            json.load(open("examples/deliveroo-order-complete.json")),
+            orjson.loads(Path("examples/deliveroo-order-ongoing.json").read_bytes()),
+            orjson.loads(Path("examples/deliveroo-order-delivering.json").read_bytes()),
+            orjson.loads(Path("examples/deliveroo-order-complete.json").read_bytes()),
         ]
 
 
 logger = logging.getLogger("slackiveroo")
-active_trackers: Dict[str, Tracker] = {}
+
+# Identifies this process among all workers sharing the same Redis
+worker_id = "%s:%d" % (socket.gethostname(), os.getpid())
+
+# Tracker run by this worker for each sharing URL, as a future resolved once
+# the tracker has been created (or with None if that failed), so that events
+# received in the meantime for the same order wait for it instead of spawning
+# a duplicate tracker
+active_trackers: Dict[str, asyncio.Future] = {}
+tracker_pool = TrackerPool()
+
+# Slack events already received (Slack retries unacknowledged deliveries),
+# mapped to their reception time (monotonic clock), oldest first
+seen_events: Dict[str, float] = OrderedDict()
+
+
+def already_seen(event_id, ttl=60, max_size=1024):
+    """
+    True if the event with the given ID was received less than ttl seconds ago
+    """
+    now = monotonic()
+    while seen_events:
+        oldest_id, received = next(iter(seen_events.items()))
+        if now - received < ttl and len(seen_events) < max_size:
+            break
+        del seen_events[oldest_id]
+
+    if event_id in seen_events:
+        return True
+    seen_events[event_id] = now
+    return False
+
+
+# When this webapp last received a request (monotonic clock)
+last_request_time: float = 0
+
+
+@web.middleware
+async def record_request_time(request, handler):
+    """
+    Keep track of the last request time, to only run the keepalive when idle
+    """
+    global last_request_time
+    last_request_time = monotonic()
+    return await handler(request)
+
+
+async def start_tracking(url, chan, redis_key):
+    """
+    Create a tracker for the given sharing URL and add it to the pool
+    """
+    future = active_trackers[url]
+    try:
+        tracker = await Tracker.from_sharing_url(url, chan, redis_key=redis_key)
+    except Exception:
+        logger.exception("Unable to start tracking %s", url)
+        del active_trackers[url]
+        future.set_result(None)
+        redis = await slack.get_redis_pool()
+        await redis.delete(redis_key + ':owner', redis_key + ':channels')
+        return
+    future.set_result(tracker)
+    tracker_pool.add(tracker)
+
+
+async def subscribe(url, chan):
+    """
+    Add a channel to the tracker for the given URL. The order is tracked by
+    at most one worker: the first one to claim it in Redis. Other workers only
+    register the channel, which the tracking worker picks up on its next poll.
+    """
+    try:
+        if url in active_trackers:
+            # Tracked by this worker: notify the channel right away
+            future = active_trackers[url]
+            tracker = await future
+            if tracker is None:
+                logger.warning("Not subscribing channel %s to %s: tracking failed",
+                               chan.channel_id, url)
+                return
+            if not tracker.failed:
+                await tracker.add_channel(chan)
+                return
+
+            # Tracking has failed since: forget it, and track the order again
+            if active_trackers.get(url) is future:
+                del active_trackers[url]
+
+        redis = await slack.get_redis_pool()
+        redis_key = "tracker:%s" % url
+        await redis.sadd(redis_key + ':channels', chan.to_json())
+        won = await redis.set(redis_key + ':owner', worker_id, expire=owner_ttl,
+                              exist=redis.SET_IF_NOT_EXIST)
+        if won and url not in active_trackers:
+            active_trackers[url] = asyncio.Future()
+            await start_tracking(url, chan, redis_key)
+    except Exception:
+        logger.exception("Unable to subscribe channel %s to %s", chan.channel_id, url)
 
 
 @slack.verify_signature
@@ -28,13 +131,20 @@ async def on_slack_event(request):
     """
     Handler for the Slack event API (HTTP POST)
     """
-    payload = await request.json()
-    logger.debug("Received event: %s", payload)
+    payload = orjson.loads(await request.read())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", payload)
 
     # Verification for app installation
     if payload['type'] == 'url_verification':
         return web.Response(text=payload['challenge'])
 
+    # Slack delivery retry of an event we already handle
+    if payload.get('event_id') and already_seen(payload['event_id']):
+        logger.info("Ignoring retry #%s of event %s",
+                    request.headers.get('X-Slack-Retry-Num'), payload['event_id'])
+        return web.Response(text="")
+
     # A "roo.it" link was shared
     evt = payload['event']
     if evt['type'] == 'link_shared':
@@ -45,15 +155,9 @@ async def on_slack_event(request):
                     team_id=payload['team_id'],
                     channel_id=evt['channel'],
                 )
-                if url in active_trackers:
-                    # Add channel if we already have a tracker for that order
-                    tracker = active_trackers[url]
-                    asyncio.ensure_future(tracker.add_channel(chan))
-                else:
-                    # Otherwise spawn a new tracker
-                    t = await Tracker.from_sharing_url(url, chan)
-                    active_trackers[link['url']] = t
-                    asyncio.ensure_future(t.run())
+                # In the background, so that we reply to Slack within its
+                # 3 seconds timeout
+                asyncio.ensure_future(subscribe(url, chan))
 
     return web.Response(text="")
 
@@ -70,32 +174,65 @@ async def on_slack_oauth(request):
 
 async def heroku_web_keepalive(ping_url=settings.SELF_QUERY_URL, period=300):
     """
-    Regulargly hit the /ping endpoint of this webapp
+    Regulargly hit the /ping endpoint of this webapp, unless it already got
+    a request in the meantime
     """
     if not ping_url:
         logger.warn("No self-query URL given, Heroku keepalive is disabled")
         return
 
-    async with ClientSession() as session:
-        while True:
-            if len(active_trackers) > 0:
-                page = await session.get(ping_url)
+    session = await slack.get_http_session()
+    while True:
+        idle = monotonic() - last_request_time >= period
+        if len(active_trackers) > 0 and idle:
+            async with session.head(ping_url) as page:
                 assert page.status == 200
-            await asyncio.sleep(period)
+        await asyncio.sleep(period)
+
+
+async def heroku_web_keepalive_context(app):
+    """
+    aiohttp cleanup context running the Heroku keepalive in the background,
+    and stopping it on shutdown
+    """
+    task = asyncio.ensure_future(heroku_web_keepalive())
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
 
 
-home_html = open("home.html").read().format(**settings.__dict__)
+async def tracker_pool_context(app):
+    """
+    aiohttp cleanup context releasing, on shutdown, the orders tracked by this
+    worker, so that other workers can track them when they are shared again
+    """
+    yield
+    await tracker_pool.close()
 
-app = web.Application()
+
+async def load_home_page(app):
+    """
+    Render the home page once, when the app starts
+    """
+    html = Path("home.html").read_text().format_map(vars(settings))
+    app['home_html'] = html.encode()
+
+
+app = web.Application(middlewares=[record_request_time])
 app.add_routes([
     web.get('/', lambda request: web.Response(
-        text=home_html,
+        body=request.app['home_html'],
         content_type='text/html'
     )),
     web.post('/slack/event', on_slack_event),
     web.get('/slack/oauth', on_slack_oauth),
     web.get('/ping', lambda request: web.Response(text="pong"))
 ])
+app.on_startup.append(load_home_page)
+app.cleanup_ctx.append(slack.redis_pool_context)
+app.cleanup_ctx.append(slack.http_session_context)
+app.cleanup_ctx.append(tracker_pool_context)
+app.cleanup_ctx.append(heroku_web_keepalive_context)
 
 logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.INFO)
 
@@ -103,5 +240,10 @@ if __name__ == "__main__":
     from sys import argv
     port = int(argv[1]) if len(argv) > 1 else 8000
 
-    asyncio.ensure_future(heroku_web_keepalive())
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop is not available, using the default event loop")
+
     web.run_app(app, port=port)
@@ -1,14 +1,20 @@
 import hmac
+import orjson
+import asyncio
 import hashlib
 import logging
 import aioredis
 from time import time
-from aiohttp import web, ClientSession
+from typing import Dict, Optional
+from aiohttp import web, ClientSession, TCPConnector
 
 import settings
 
 logger = logging.getLogger('slack')
 
+# Access tokens already fetched from Redis, per team ID
+_token_cache: Dict[str, str] = {}
+
 
 class Channel:
     """
@@ -18,23 +24,48 @@ class Channel:
         self.team_id, self.channel_id = team_id, channel_id
         self.token = None  # This is filled lazily from Redis
 
+    def to_json(self):
+        """
+        Serialize this channel, to share it with other workers through Redis
+        """
+        return orjson.dumps({'team_id': self.team_id, 'channel_id': self.channel_id})
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Build a channel from its serialized form (see to_json)
+        """
+        return cls(**orjson.loads(data))
+
+    @property
+    def key(self):
+        """
+        The (team ID, channel ID) pair identifying this channel
+        """
+        return (self.team_id, self.channel_id)
+
     def __eq__(self, other):
         """
         True if both channels have the same team and channel IDs
         """
-        return (self.team_id, self.channel_id) == (other.team_id, other.channel_id)
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     async def get_token(self):
         """
         Get the access token to post to this channel. If not already present
-        as attribute, retrieves it from Redis
+        as attribute, retrieves it from the tokens cache or from Redis
         """
         if not self.token:
-            redis = await aioredis.create_redis_pool(settings.REDIS_URL)
+            self.token = _token_cache.get(self.team_id)
+        if not self.token:
+            redis = await get_redis_pool()
             self.token = await redis.hget('slackiveroo.tokens', self.team_id,
                                           encoding='utf-8')
-            redis.close()
-            await redis.wait_closed()
+            if self.token:
+                _token_cache[self.team_id] = self.token
         return self.token
 
     async def join(self, http_session):
@@ -44,93 +75,181 @@ class Channel:
         token = await self.get_token()
         posted = await http_session.post(
             "https://slack.com/api/conversations.join",
-            headers={'Authorization': 'Bearer %s' % token},
-            json={
+            headers={
+                'Authorization': 'Bearer %s' % token,
+                'Content-Type': 'application/json; charset=utf-8',
+            },
+            data=orjson.dumps({
                 'channel': self.channel_id
-            }
+            })
         )
         assert posted.status == 200
-        response = await posted.json()
+        response = orjson.loads(await posted.read())
         assert response['ok'], str(response)
 
-    async def post_message(self, text, blocks, http_session):
+    async def post_message(self, text, blocks, http_session, message=None):
         """
         Post a message to this channel, with the given plain text (used in
         desktop notifications), blocks (used in Slack app for rich display),
-        using the given http session.
+        using the given http session. The text and blocks may also be given
+        already serialized (see serialize_message).
         See https://api.slack.com/methods/chat.postMessage
         """
+        if message is None:
+            message = serialize_message(text, blocks)
         token = await self.get_token()
         posted = await http_session.post(
             "https://slack.com/api/chat.postMessage",
-            headers={'Authorization': 'Bearer %s' % token},
-            json={
-                'channel': self.channel_id,
-                'blocks': blocks,
-                'text': text
+            headers={
+                'Authorization': 'Bearer %s' % token,
+                'Content-Type': 'application/json; charset=utf-8',
             },
+            # Add the channel to the serialized message JSON object
+            data=message[:-1] + b',"channel":' + orjson.dumps(self.channel_id) + b'}',
         )
         assert posted.status == 200
-        response = await posted.json()
+        response = orjson.loads(await posted.read())
         if not response['ok'] and response['error'] == 'not_in_channel':
             await self.join(http_session)
-            await self.post_message(text, blocks, http_session)
+            await self.post_message(text, blocks, http_session, message)
         else:
             assert response['ok'], str(response)
 
 
-def get_http_session():
+_http_session: Optional[ClientSession] = None
+_redis_pool: Optional[aioredis.Redis] = None
+
+
+async def get_http_session():
+    """
+    Get the HTTP client session shared by the whole app, creating it on first
+    use, so that connections are kept alive between requests
+    """
+    global _http_session
+    if _http_session is None:
+        _http_session = ClientSession(
+            connector=TCPConnector(limit=100, limit_per_host=20,
+                                   keepalive_timeout=75, ttl_dns_cache=300),
+            headers={'User-Agent': 'titouanc/slackiveroo'},
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """
+    Close the shared HTTP client session, if any
+    """
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+async def http_session_context(app):
     """
-    Create a new HTTP client session
+    aiohttp cleanup context closing the shared HTTP session on shutdown
     """
-    return ClientSession(headers={'User-Agent': 'titouanc/slackiveroo'})
+    yield
+    await close_http_session()
+
+
+async def get_redis_pool():
+    """
+    Get the Redis connection pool shared by the whole app, creating it on
+    first use
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = await aioredis.create_redis_pool(
+            settings.REDIS_URL, minsize=1, maxsize=10
+        )
+    return _redis_pool
+
+
+async def close_redis_pool():
+    """
+    Close the shared Redis connection pool, if any
+    """
+    global _redis_pool
+    if _redis_pool is not None:
+        _redis_pool.close()
+        await _redis_pool.wait_closed()
+        _redis_pool = None
+
+
+async def redis_pool_context(app):
+    """
+    aiohttp cleanup context opening the shared Redis connection pool on
+    startup, and closing it on shutdown
+    """
+    await get_redis_pool()
+    yield
+    await close_redis_pool()
 
 
 async def get_oauth_token(grant_code):
-    async with get_http_session() as session:
-        page = await session.post("https://slack.com/api/oauth.v2.access", data={
-            "client_id": settings.SLACK_CLIENT_ID,
-            "client_secret": settings.SLACK_CLIENT_SECRET,
-            "code": grant_code,
-        })
-        assert page.status == 200
-        auth = await page.json()
-        if not auth['ok']:
-            raise Exception("Invalid OAuth2 access: " + auth['error'])
+    session = await get_http_session()
+    page = await session.post("https://slack.com/api/oauth.v2.access", data={
+        "client_id": settings.SLACK_CLIENT_ID,
+        "client_secret": settings.SLACK_CLIENT_SECRET,
+        "code": grant_code,
+    })
+    assert page.status == 200
+    auth = orjson.loads(await page.read())
+    if not auth['ok']:
+        raise Exception("Invalid OAuth2 access: " + auth['error'])
 
+    if logger.isEnabledFor(logging.DEBUG):
         logger.debug("AUTH: %s", auth)
 
-        logger.info(
-            "Got OAuth2 %s token with scope %s as %s in Team %s: %s",
-            auth["token_type"], auth['scope'], auth['bot_user_id'],
-            auth['team']['name'], auth['access_token']
-        )
+    logger.info(
+        "Got OAuth2 %s token with scope %s as %s in Team %s: %s",
+        auth["token_type"], auth['scope'], auth['bot_user_id'],
+        auth['team']['name'], auth['access_token']
+    )
+
+    redis = await get_redis_pool()
+    await redis.hset('slackiveroo.tokens', auth['team']['id'], auth['access_token'])
+    _token_cache[auth['team']['id']] = auth['access_token']
+
 
-        redis = await aioredis.create_redis_pool(settings.REDIS_URL)
-        await redis.hset('slackiveroo.tokens', auth['team']['id'], auth['access_token'])
-        redis.close()
-        await redis.wait_closed()
+def serialize_message(text, blocks):
+    """
+    Serialize the parts of a message that are common to all channels, as a
+    JSON object
+    """
+    return orjson.dumps({'blocks': blocks, 'text': text})
 
 
 async def post_message(channels, text, blocks):
     """
-    Post a message to a list of channels
+    Post a message to a list of channels, concurrently. A failure to post to
+    one channel is logged and does not prevent posting to the others.
     """
-    async with get_http_session() as session:
-        for chan in channels:
-            await chan.post_message(text, blocks, session)
+    session = await get_http_session()
+    message = serialize_message(text, blocks)
+    results = await asyncio.gather(
+        *(chan.post_message(text, blocks, session, message) for chan in channels),
+        return_exceptions=True
+    )
+    for chan, result in zip(channels, results):
+        if isinstance(result, Exception):
+            logger.error(
+                "Unable to post message to channel %s in team %s: %r",
+                chan.channel_id, chan.team_id, result
+            )
 
 
-def sign_request(timestamp, message, key=settings.SLACK_SIGN_SECRET):
+def sign_request(timestamp, message, key=settings.SLACK_SIGN_SECRET.encode()):
     """
-    Compute the Slack Signature hash.
+    Compute the Slack Signature hash of a raw (bytes) request body.
     See details on https://api.slack.com/docs/verifying-requests-from-slack
     """
-    version = 'v0'
-    msg = f'{version}:{timestamp}:{message}'
-    return version + '=' + hmac.new(
-        key=key.encode(),
-        msg=msg.encode(),
+    version = b'v0'
+    msg = b'%s:%d:%s' % (version, timestamp, message)
+    return 'v0=' + hmac.new(
+        key=key,
+        msg=msg,
         digestmod=hashlib.sha256,
     ).hexdigest()
 
@@ -141,8 +260,18 @@ def verify_signature(func):
     Otherwise, return a 403.
     """
     async def wrapper(request, *args, **kwargs):
-        body = await request.text()
-        timestamp = int(request.headers['X-Slack-Request-Timestamp'])
+        # Check the timestamp first, so that replayed requests are rejected
+        # without reading and hashing their body
+        try:
+            timestamp = int(request.headers['X-Slack-Request-Timestamp'])
+        except (KeyError, ValueError):
+            logger.error(
+                "Slack request cannot be authenticated: "
+                "missing or invalid timestamp (%s)",
+                request.headers.get('X-Slack-Request-Timestamp')
+            )
+            return web.Response(text="Invalid timestamp", status=403)
+
         if abs(time() - timestamp) > 300:
             logger.error(
                 "Slack request cannot be authenticated: "
@@ -151,14 +280,16 @@ def verify_signature(func):
             )
             return web.Response(text="Invalid timestamp", status=403)
 
+        body = await request.read()
         signature = sign_request(timestamp, body)
-        if signature == request.headers['X-Slack-Signature']:
+        given = request.headers.get('X-Slack-Signature', '')
+        if hmac.compare_digest(signature, given):
             return await func(request, *args, **kwargs)
         else:
             logger.error(
                 "Slack request cannot be authenticated: "
                 "signature mismatch (given: %s, computed: %s)",
-                signature, request.headers['X-Slack-Signature']
+                given, signature
             )
             return web.Response(text="You're not Slack", status=403)
     return wrapper
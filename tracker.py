@@ -1,79 +1,250 @@
 import re
+import orjson
+import random
 import asyncio
 import logging
-from aiohttp import ClientSession
+import aioredis
+from time import monotonic
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict
+from collections import deque
+from aiohttp import ClientError, ClientTimeout
 
 import slack
 import settings
 
 logger = logging.getLogger('tracker')
 api_root = "https://order-status.deliveroo.net/api/v2-4"
+numbers = re.compile(r'\d+')
+status_fields = re.compile(rb'"(ui_status|message|eta_message)"\s*:\s*"([^"\\]*)"')
+
+# Maximum polling period (in seconds) for the order status messages where we
+# don't want to back off as much as by default. Deliveroo reports the same
+# ui_status (PROGRESS) while the order is prepared and delivered, so this is
+# keyed on the message instead.
+max_polling_periods = {
+    'The order is being delivered': 20,
+}
+
+# How long (in seconds) a worker's claim on an order lasts in Redis, unless
+# renewed by polling it. Short, so that an order claimed by a worker which died
+# without releasing it can soon be tracked again.
+owner_ttl = 300
+
+# Slack status update templates
+failed_template = "@here :rotating_light: The order from *%s* has *FAILED* _(%s)_\n%s"
+arrived_template = "*%s* is here, @hungry people :bowl_with_spoon: !"
+ongoing_template = "*%s*: %s\n*ETA*: %s\n%s"
+
+
+def same_status(body, deliveroo_state):
+    """
+    True if the raw Deliveroo response body has the same ui_status, message
+    and eta_message as the given (parsed) response. This only looks for these
+    fields in the body; False if they cannot be found unambiguously.
+    """
+    fields = {}
+    for match in status_fields.finditer(body):
+        name, value = match.group(1).decode(), match.group(2).decode()
+        if name in fields:
+            return False
+        fields[name] = value
+
+    attributes = deliveroo_state['data']['attributes']
+    return 'ui_status' in fields and 'message' in fields and all(
+        fields.get(name) == attributes.get(name)
+        for name in ('ui_status', 'message', 'eta_message')
+    )
+
+
+def retry_after(value, default=30, maximum=120):
+    """
+    Convert a Retry-After header value (a delay in seconds, or an HTTP date)
+    to a delay in seconds, capped to the given maximum
+    """
+    if value is None:
+        return default
+    try:
+        delay = int(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        delay = int((date - datetime.now(timezone.utc)).total_seconds())
+    return max(0, min(delay, maximum))
+
+
+class TrackerError(Exception):
+    """
+    Raised when an order cannot be tracked
+    """
+
+
+class RetryLater(TrackerError):
+    """
+    Raised on transient errors, when the order status should be requested
+    again later (after the given delay in seconds, if any)
+    """
+    def __init__(self, message, delay=None):
+        super(RetryLater, self).__init__(message)
+        self.delay = delay
 
 
 class Tracker:
     """
     ALl the state needed to track an ongoing Deliveroo order
     """
-    def __init__(self, tracking_url, *channels):
-        self.channels = list(channels)   # Channles to which to post status updates
+    def __init__(self, tracking_url, *channels, redis_key=None):
+        self.channels = {                # Channels to which to post status updates,
+            chan.key: chan               # by (team ID, channel ID)
+            for chan in channels
+        }
         self.completed = False           # True if the order is complete (no more tracking)
+        self.failed = False              # True if tracking failed (no more tracking)
         self.tracking_url = tracking_url # The deliveroo API tracking URL
         self.current_state = None        # The current deliveroo status
+        self.redis_keys = []             # Redis keys prefixes shared with other workers,
+        if redis_key is not None:        # one per sharing URL of this order
+            self.redis_keys.append(redis_key)
+        self.last_update = None          # The last (status, message) posted to Slack
+        self.unchanged_polls = 0         # Number of polls since the last update
+        self.next_poll = 0               # When to poll Deliveroo next (monotonic clock)
+        self.failures = 0                # Number of successive failed polls
+        self.formatted = {}              # Recently formatted Slack status updates
+        self.pool = None                 # The pool running this tracker, if any
+        self.image_url = None            # The restaurant preview image URL
+        self.etag = None                 # The ETag of the current deliveroo status
+        self.last_modified = None        # The Last-Modified of the current deliveroo status
 
     @classmethod
-    async def from_sharing_url(cls, sharing_url, *channels):
-        """
-        Obtain a tracker from a sharing url (https://roo.it/s/...)
-        """
-        async with slack.get_http_session() as session:
-            # 1. Get client frontend page via the shortlink redirection
-            page = await session.get(sharing_url)
-            assert page.status == 200
-            logger.info("Frontend url for %s is %s", sharing_url, page.url)
-
-            # 2. Extract the order ID and access token from the frontend URL
-            path = re.match(r'.*/orders/(\d+)/status$', page.url.path)
-            url = "{api}/consumer_order_statuses/{order}?sharing_token={token}"
-            tracking_url = url.format(
-                api=api_root,
-                order=path.group(1),
-                token=page.url.query['sharing_token']
-            )
-            return cls(tracking_url, *channels)
+    async def from_sharing_url(cls, sharing_url, *channels, redis_key=None):
+        """
+        Obtain a tracker from a sharing url (https://roo.it/s/...). If the order
+        is already tracked (from another sharing url), return that tracker.
+        """
+        session = await slack.get_http_session()
+
+        # 1. Get client frontend page url via the shortlink redirection,
+        #    without downloading the page (unless HEAD is not supported)
+        try:
+            async with session.head(sharing_url, allow_redirects=True) as page:
+                http_status, frontend_url = page.status, page.url
+        except ClientError as err:
+            logger.warning("HEAD %s failed (%r), trying GET", sharing_url, err)
+            http_status = None
+        if http_status != 200:
+            async with session.get(sharing_url) as page:
+                http_status, frontend_url = page.status, page.url
+        if http_status != 200:
+            raise TrackerError(f"HTTP {http_status} for {sharing_url}")
+        logger.info("Frontend url for %s is %s", sharing_url, frontend_url)
+
+        # 2. Extract the order ID and access token from the frontend URL
+        #    (its path ends with /orders/<order id>/status)
+        path = frontend_url.path.rsplit('/', 3)
+        if len(path) < 4 or path[-3] != 'orders' or path[-1] != 'status' \
+           or not path[-2].isdigit():
+            raise TrackerError(f"Unexpected frontend url {frontend_url}")
+        order_id = path[-2]
+        token = frontend_url.query['sharing_token']
+        tracking_url = f"{api_root}/consumer_order_statuses/{order_id}?sharing_token={token}"
+
+        # 3. Reuse the tracker of that order if there is one
+        tracker = trackers_by_url.get(tracking_url)
+        if tracker is not None:
+            if redis_key is not None and redis_key not in tracker.redis_keys:
+                tracker.redis_keys.append(redis_key)
+            await tracker.add_channels(channels)
+        else:
+            tracker = cls(tracking_url, *channels, redis_key=redis_key)
+            trackers_by_url[tracking_url] = tracker
+        return tracker
 
     async def add_channel(self, chan):
         """
         Add a channel to be notified when the order status changes
         """
+        await self.add_channels([chan])
+
+    async def add_channels(self, channels):
+        """
+        Add channels to be notified when the order status changes
+        """
         # 1. Do not duplicate channels
-        for known_chan in self.channels:
-            if chan == known_chan:
-                return
-        self.channels.append(chan)
+        new_channels = []
+        for chan in channels:
+            if chan.key not in self.channels:
+                self.channels[chan.key] = chan
+                new_channels.append(chan)
 
-        # 2. Post a status update if the status is already known
-        if self.current_state is not None:
+        # 2. Post a status update if the status is already known, formatted
+        #    once for all the new channels
+        if new_channels and self.current_state is not None:
             text, blocks = self.format_slack_status_update(self.current_state)
-            await slack.post_message([chan], text, blocks)
+            await slack.post_message(new_channels, text, blocks)
+
+    async def refresh_channels(self, ttl=3600):
+        """
+        Add the channels registered in Redis by any worker for this order, and
+        keep this tracker ownership alive
+        """
+        redis = await slack.get_redis_pool()
+        members = set()
+        for redis_key in self.redis_keys:
+            await redis.expire(redis_key + ':owner', owner_ttl)
+            await redis.expire(redis_key + ':channels', ttl)
+            members |= set(await redis.smembers(redis_key + ':channels',
+                                                encoding='utf-8'))
+        await self.add_channels([slack.Channel.from_json(m) for m in members])
+
+    async def release_claims(self):
+        """
+        Release this order in Redis, so that it is tracked again (by any
+        worker) when shared again
+        """
+        if not self.redis_keys:
+            return
+        redis = await slack.get_redis_pool()
+        for redis_key in self.redis_keys:
+            await redis.delete(redis_key + ':owner', redis_key + ':channels')
 
-    def format_slack_status_update(self, deliveroo_state):
+    def format_slack_status_update(self, deliveroo_state, attributes=None):
         """
-        Format a deliveroo API response into Slack text and blocks
+        Format a deliveroo API response into Slack text and blocks. The
+        response data attributes may be given if the caller already has them.
         """
-        assert deliveroo_state['included'][0]['type'] == 'order'
-        order = deliveroo_state['included'][0]['attributes']
+        if attributes is None:
+            attributes = deliveroo_state['data']['attributes']
+        key = (attributes['ui_status'], attributes['message'],
+               attributes.get('eta_message'))
+        if key not in self.formatted:
+            if len(self.formatted) >= 8:
+                self.formatted.clear()
+            included = deliveroo_state.get('included')
+            if not included or included[0]['type'] != 'order':
+                raise TrackerError("No order in Deliveroo response")
+            order = deliveroo_state['included'][0]['attributes']
+            self.formatted[key] = self._format_slack_status_update(order, attributes)
+        return self.formatted[key]
+
+    def _format_slack_status_update(self, order, attributes):
+        if self.image_url is None:
+            self.image_url = order['image_url'].format(w=192, h=108)
 
-        attributes = deliveroo_state['data']['attributes']
         if attributes['ui_status'] == 'FAILED':
-            text = "@here :rotating_light: The order from *%s* has *FAILED* _(%s)_\n%s" % (
+            text = failed_template % (
                 order['restaurant_name'],
                 attributes['message'],
                 order['sharing_short_url'],
             )
         elif 'eta_message' not in attributes:
-            text = "*%s* is here, @hungry people :bowl_with_spoon: !" % order['restaurant_name']
+            text = arrived_template % order['restaurant_name']
         else:
-            text = "*%s*: %s\n*ETA*: %s\n%s" % (
+            text = ongoing_template % (
                 order['restaurant_name'],
                 attributes['message'],
                 attributes['eta_message'],
@@ -85,46 +256,256 @@ class Tracker:
             "text": {"type": "mrkdwn", "text": text},
             "accessory": {
                 "type": "image",
-                "image_url": order['image_url'].format(w=192, h=108),
+                "image_url": self.image_url,
                 "alt_text": "Restaurant preview",
             }
         }
 
-        return text.split('\n')[0], [block]
+        return text.partition('\n')[0], [block]
 
-    async def get_order_status(self):
-        async with slack.get_http_session() as session:
-            page = await session.get(self.tracking_url)
-            assert page.status == 200
-            return await page.json()
+    async def get_order_status(self, timeout=ClientTimeout(total=10)):
+        """
+        Get the order status from Deliveroo. Raises RetryLater on transient
+        errors (network errors, 5xx and 429 responses).
+        Uses a conditional request once the status is known, so that an
+        unchanged status is not downloaded again, nor parsed again.
+        """
+        session = await slack.get_http_session()
+        headers = {}
+        if self.current_state is not None and self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.current_state is not None and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        try:
+            async with session.get(self.tracking_url, headers=headers,
+                                   timeout=timeout) as page:
+                if page.status == 304:
+                    return self.current_state
+                elif page.status == 429:
+                    delay = retry_after(page.headers.get('Retry-After'))
+                    raise RetryLater("HTTP 429", delay)
+                elif page.status >= 500:
+                    raise RetryLater(f"HTTP {page.status}")
+                elif page.status != 200:
+                    raise TrackerError(f"HTTP {page.status}")
+
+                self.etag = page.headers.get('ETag')
+                self.last_modified = page.headers.get('Last-Modified')
+                body = await page.read()
+        except (ClientError, asyncio.TimeoutError) as err:
+            raise RetryLater(repr(err)) from err
+
+        if self.current_state is not None and same_status(body, self.current_state):
+            return self.current_state
+        return orjson.loads(body)
+
+    async def process_status(self, state):
+        """
+        Handle an order status obtained from Deliveroo, and return its data
+        attributes
+        """
+        self.current_state = state
+        attributes = state['data']['attributes']
+        status, msg = attributes['ui_status'], attributes['message']
+
+        # 1. Post a status update to Slack when the status or user message
+        #    changes, ignoring numbers in the message (such as a countdown
+        #    in minutes) so that we don't post every time they tick
+        update = (status, numbers.sub('#', msg))
+        if update != self.last_update:
+            text, blocks = self.format_slack_status_update(state, attributes)
+            logger.info(f"[{self.tracking_url}] {status} :: {msg}")
+            if self.pool is not None:
+                self.pool.queue_message(self.channels.values(), text, blocks)
+            else:
+                await slack.post_message(list(self.channels.values()), text, blocks)
+            self.last_update = update
+            self.unchanged_polls = 0
+        else:
+            self.unchanged_polls += 1
+
+        # 2. Stop tracking when the order is delivered
+        if status in ('COMPLETED', 'FAILED'):
+            logger.info(f"Tracking {self.tracking_url} has ended ({status})")
+            self.completed = True
+        return attributes
 
-    async def run(self, polling_period_seconds=15):
+    async def poll(self, polling_period_seconds=15, max_polling_period_seconds=120,
+                   max_failures=5):
         """
-        Async task that tracks the Deliveroo order until complete
+        Update the order status, and schedule the next poll. The polling
+        period doubles (up to a maximum) while the status is unchanged, and is
+        reset as soon as it changes. On transient errors, the next poll is
+        scheduled with an exponential backoff, until too many polls in a row
+        have failed.
         """
-        logger.info(f"Starting to track {self.tracking_url}")
-        last_msg = None
-        while not self.completed:
-            # 1. Get status from Deliveroo
-            self.current_state = await self.get_order_status()
-            status = self.current_state['data']['attributes']['ui_status']
-            msg = self.current_state['data']['attributes']['message']
+        # 1. Pick up channels subscribed through other workers
+        #    (if Redis is unavailable, keep polling for the known channels)
+        if self.redis_keys:
+            try:
+                await self.refresh_channels()
+            except (aioredis.RedisError, OSError, asyncio.TimeoutError) as err:
+                logger.warning("[%s] Unable to refresh channels: %r",
+                               self.tracking_url, err)
 
-            # 2. Post a status update to Slack when the user message changes
-            if msg != last_msg:
-                text, blocks = self.format_slack_status_update(self.current_state)
-                logger.info(f"[{self.tracking_url}] {status} :: {msg}")
-                await slack.post_message(self.channels, text, blocks)
-                last_msg = msg
+        # 2. Get status from Deliveroo, or retry later
+        try:
+            state = await self.get_order_status()
+        except RetryLater as err:
+            self.failures += 1
+            if self.failures >= max_failures:
+                raise TrackerError(
+                    f"Unable to get order status after {self.failures} attempts"
+                ) from err
+            delay = err.delay if err.delay is not None else 2 ** (self.failures - 1)
+            logger.warning("[%s] %s, retrying in %ds", self.tracking_url, err, delay)
+            self.next_poll = monotonic() + delay
+            return
+        self.failures = 0
+        attributes = await self.process_status(state)
 
-            # 3. Stop tracking when the order is delivered
-            if status in ('COMPLETED', 'FAILED'):
-                logger.info(f"Tracking {self.tracking_url} has ended ({status})")
-                self.completed = True
-                break
+        # 3. Then wait a bit, longer if nothing happened recently, but not
+        #    too long at the stages where things move fast. A small random
+        #    delay spreads the polls of trackers started at the same time.
+        max_period = max_polling_periods.get(attributes['message'],
+                                             max_polling_period_seconds)
+        period = min(max_period,
+                     polling_period_seconds * 2 ** min(self.unchanged_polls, 3))
+        self.next_poll = monotonic() + period + random.uniform(0, 2)
 
-            # 4. Then wait a bit
-            await asyncio.sleep(polling_period_seconds)
+
+# Trackers of the ongoing orders, by tracking URL
+trackers_by_url: Dict[str, Tracker] = {}
+
+
+class TrackerPool:
+    """
+    Run a set of trackers until their order is complete. All the trackers due
+    for an update are polled together at each tick, rather than each one
+    waking up on its own. A poll still running at the end of the tick carries
+    on in the background, without holding up the other trackers.
+    """
+    def __init__(self, tick_seconds=5):
+        self.trackers = []                # Trackers of the ongoing orders
+        self.tick_seconds = tick_seconds  # Time between two polling rounds
+        self.task = None                  # The polling task, while running
+        self.polls = {}                   # Ongoing poll tasks, by tracker
+        self.messages = []                # Slack messages to post at the end of
+                                          # the round, as (text, blocks)
+        self.outbox = {}                  # Indexes in messages of the ones to
+                                          # post to each channel, by channel key
+
+    def add(self, tracker):
+        """
+        Start tracking an order, unless its tracker is already in the pool
+        """
+        if tracker in self.trackers:
+            return
+        logger.info(f"Starting to track {tracker.tracking_url}")
+        tracker.pool = self
+        self.trackers.append(tracker)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self, tracker):
+        """
+        Forget a tracker no longer in the pool, and release its Redis claims
+        """
+        if trackers_by_url.get(tracker.tracking_url) is tracker:
+            del trackers_by_url[tracker.tracking_url]
+        try:
+            await tracker.release_claims()
+        except Exception:
+            logger.exception("Unable to release %s in Redis", tracker.tracking_url)
+
+    async def close(self):
+        """
+        Stop polling, and release the Redis claims of all the trackers
+        """
+        tasks = list(self.polls.values())
+        if self.task is not None:
+            tasks.append(self.task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.polls = {}
+        for tracker in self.trackers:
+            await self.stop(tracker)
+        self.trackers = []
+
+    def queue_message(self, channels, text, blocks):
+        """
+        Queue a message to post to the given channels at the end of the
+        current polling round
+        """
+        index = len(self.messages)
+        self.messages.append((text, blocks))
+        for chan in channels:
+            self.outbox.setdefault(chan.key, (chan, []))[1].append(index)
+
+    async def flush_outbox(self):
+        """
+        Post the queued messages, combined into a single message per channel
+        """
+        # Channels which got the same messages get the same combined message,
+        # posted to all of them at once
+        recipients = {}
+        for chan, indexes in self.outbox.values():
+            recipients.setdefault(tuple(indexes), []).append(chan)
+        messages, self.messages, self.outbox = self.messages, [], {}
+
+        results = await asyncio.gather(*(
+            slack.post_message(
+                channels,
+                '\n'.join(messages[i][0] for i in indexes),
+                [block for i in indexes for block in messages[i][1]],
+            )
+            for indexes, channels in recipients.items()
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Unable to post status updates: %r", result)
+
+    async def run(self):
+        """
+        Async task that polls the trackers until all orders are complete
+        """
+        while self.trackers:
+            # 1. Poll all trackers due for an update at once, waiting for
+            #    their polls at most until the end of the tick
+            start = monotonic()
+            for tracker in self.trackers:
+                if tracker not in self.polls and tracker.next_poll <= start:
+                    self.polls[tracker] = asyncio.ensure_future(tracker.poll())
+            if self.polls:
+                await asyncio.wait(list(self.polls.values()),
+                                   timeout=self.tick_seconds)
+            try:
+                await self.flush_outbox()
+            except Exception:
+                logger.exception("Unable to post the queued status updates")
+
+            # 2. Stop tracking completed orders, and trackers that failed
+            for tracker, task in list(self.polls.items()):
+                if not task.done():
+                    continue
+                del self.polls[tracker]
+                if task.exception() is not None:
+                    logger.error("Tracking %s has failed: %r",
+                                 tracker.tracking_url, task.exception())
+                    tracker.failed = True
+            stopped = [
+                t for t in self.trackers
+                if t not in self.polls and (t.completed or t.failed)
+            ]
+            self.trackers = [t for t in self.trackers if t not in stopped]
+            for tracker in stopped:
+                await self.stop(tracker)
+
+            # 3. Then wait until the next round
+            if self.trackers:
+                await asyncio.sleep(max(0, start + self.tick_seconds - monotonic()))
 
 
 class MockingTracker(Tracker):
@@ -134,10 +515,15 @@ class MockingTracker(Tracker):
     
     class MyTracker(MockingTracker):
         responses = [{"data": {"attributes": {"ui_status": "COMPLETED"}}}]
+
+    Set the class attribute simulate_latency to False to get the responses
+    without delay.
     """
+    simulate_latency = True
+
     def __init__(self, *args, **kwargs):
         super(MockingTracker, self).__init__(*args, **kwargs)
-        self.backlog = self.responses
+        self.backlog = deque(self.responses)
 
     @classmethod
     async def from_sharing_url(cls, rooit_url, *args, **kwargs):
@@ -145,6 +531,6 @@ class MockingTracker(Tracker):
         return cls("[MOCK]", *args, **kwargs)
 
     async def get_order_status(self):
-        await asyncio.sleep(.125)
-        this_response, self.backlog = self.backlog[0], self.backlog[1:]
-        return this_response
+        if self.simulate_latency:
+            await asyncio.sleep(.125)
+        return self.backlog.popleft()